@@ -9,10 +9,15 @@ simple statistical analysis and goal follow-up.
 # pylint: disable=wrong-import-position, ungrouped-imports
 # matplotlib quirk
 
+import asyncio
+import atexit
 import configparser
-import csv
+import io
 import logging
-import tempfile
+import re
+import threading
+import time
+from functools import lru_cache
 from pathlib import Path
 
 import matplotlib
@@ -20,7 +25,8 @@ import numpy as np
 import pandas as pd
 import pendulum
 import telegram
-from pandas.plotting import register_matplotlib_converters
+from numba import njit
+from numba.types import Tuple, float32, float64, int64
 from telegram.ext import (
     Application,
     CallbackContext,
@@ -32,17 +38,25 @@ from telegram.ext.filters import MessageFilter
 
 matplotlib.use("agg")
 
+import matplotlib.dates as mdates
 import matplotlib.pyplot as plt
 
-register_matplotlib_converters()
-
-
 BASEDIR = Path(__file__).parent
 
 CONFIG = configparser.ConfigParser(inline_comment_prefixes="#")
 CONFIG.read((BASEDIR / "config", BASEDIR / "config.local"))
 CONFIG = CONFIG["weightbot"]
 
+# frozen once at import: configparser's section proxy re-runs case
+# folding and default-section logic on every lookup
+CSVFILE = Path(CONFIG["csvfile"])
+GOAL = np.float32(CONFIG["goal"])  # kg diff per month
+GOAL_SLOPE = np.float32(12 * GOAL / 365)  # kg per elapsed day
+
+# resolved once: pendulum.now() without an argument re-runs timezone
+# discovery (env lookup, zoneinfo parse) on every call
+_TZ = pendulum.local_timezone()
+
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
     level=logging.INFO,
@@ -50,6 +64,209 @@ logging.basicConfig(
 
 LOGGER = logging.getLogger(__name__)
 
+_CACHE = {"mtime": None, "offset": 0, "df": None}
+_CACHE_LOCK = threading.Lock()
+
+# measurement rows buffered in memory between flushes to the CSV file
+_PENDING = []
+_FLUSH_INTERVAL = 30  # seconds
+_FLUSH_TASK = None
+
+
+@lru_cache(maxsize=4)
+def _make_axes(last, resample, goal):
+    """Long-lived Figure per distinct /stats parameter combination.
+
+    Only two combinations occur in practice (the /stats default and the
+    post-weight variant); caching on them keeps figure construction out
+    of the per-call path.
+    """
+    return plt.subplots()
+
+
+def _flush_pending():
+    """Append the buffered measurement rows to the CSV file in one write."""
+    with _CACHE_LOCK:
+        if not _PENDING:
+            return
+        with open(
+            CSVFILE, mode="a", buffering=1, encoding="utf-8"
+        ) as csvfile:
+            csvfile.writelines(_PENDING)
+        _PENDING.clear()
+        if _CACHE["df"] is not None:
+            # the rows are already in the cached frame, so mark the file
+            # content as consumed
+            stat = CSVFILE.stat()
+            _CACHE["mtime"] = stat.st_mtime
+            _CACHE["offset"] = stat.st_size
+
+
+async def _start_flush_task(application):
+    """Kick off the periodic flush of buffered measurement rows."""
+    # pylint: disable=global-statement
+    global _FLUSH_TASK
+
+    async def flush_loop():
+        while True:
+            await asyncio.sleep(_FLUSH_INTERVAL)
+            _flush_pending()
+
+    # deliberately not application.create_task: Application.stop()
+    # gathers those without a timeout and would wait on this loop forever
+    _FLUSH_TASK = asyncio.create_task(flush_loop())
+
+
+async def _stop_flush_task(application):
+    """Cancel the periodic flush and write out whatever is buffered."""
+    if _FLUSH_TASK is not None:
+        _FLUSH_TASK.cancel()
+    _flush_pending()
+
+
+def _humans(timestamp):
+    """Rough "n days ago" wording for a tz-aware timestamp.
+
+    Cheap stand-in for pendulum's diff_for_humans, which boxes the value
+    into a pendulum DateTime and builds several timezone objects per call.
+    """
+    seconds = time.time() - timestamp.timestamp()
+    for unit, size in (("day", 86400), ("hour", 3600), ("minute", 60)):
+        if seconds >= size:
+            count = int(seconds // size)
+            return f"{count} {unit}{'s' if count > 1 else ''} ago"
+    return "just now"
+
+
+def _period_ns(resample):
+    """Nanoseconds per resample bucket (offset aliases like "W", "10d")."""
+    if not resample[0].isdigit():
+        resample = "1" + resample
+    return np.int64(pd.Timedelta(resample).value)
+
+
+# the explicit signature forces compilation at import time, so the first
+# /stats does not pay the JIT cost
+@njit(
+    Tuple((float64, int64, int64, int64[:], float64[:]))(
+        int64[:], float32[:], int64, int64
+    ),
+    cache=True,
+    fastmath=True,
+)
+def _stats_kernel(ts_i8, weights, cutoff, period_ns):
+    """Walk the series once: trailing mean, min/max and bucket means.
+
+    Fuses what were separate pandas passes (last-7d mean, idxmin/idxmax,
+    resample-mean) into a single loop over the sorted arrays.  Returns
+    the trailing mean since `cutoff`, the min/max positions, and the
+    bucket start timestamps (ns) with their mean weights.
+
+    Bucket semantics deliberately differ from DataFrame.resample:
+    buckets are fixed-width intervals anchored to the Unix epoch in UTC
+    (so "W" starts on Thursdays, not resample's Sunday-anchored local
+    weeks), and empty periods are skipped rather than emitted as NaN,
+    so gaps do not break the plotted means line.
+    """
+    size = ts_i8.size
+    imin = 0
+    imax = 0
+    tail_sum = 0.0
+    tail_count = 0
+    starts = np.empty(size, dtype=np.int64)
+    sums = np.zeros(size)
+    counts = np.zeros(size)
+    nbuckets = 0
+    current = ts_i8[0] // period_ns
+    starts[0] = current * period_ns
+    for i in range(size):
+        if weights[i] < weights[imin]:
+            imin = i
+        if weights[i] > weights[imax]:
+            imax = i
+        if ts_i8[i] >= cutoff:
+            tail_sum += weights[i]
+            tail_count += 1
+        bucket = ts_i8[i] // period_ns
+        if bucket != current:
+            nbuckets += 1
+            current = bucket
+            starts[nbuckets] = bucket * period_ns
+        sums[nbuckets] += weights[i]
+        counts[nbuckets] += 1.0
+    nbuckets += 1
+    return (
+        tail_sum / tail_count,
+        imin,
+        imax,
+        starts[:nbuckets],
+        sums[:nbuckets] / counts[:nbuckets],
+    )
+
+
+def _load_data():
+    """Return the parsed CSV as a DataFrame, kept cached in memory.
+
+    The file only ever grows through store_weight, so the parsed frame is
+    reused across calls.  When the file did change on disk, only the bytes
+    appended since the last read are parsed and concatenated, keeping each
+    call O(new rows) instead of O(history).
+    """
+    with _CACHE_LOCK:
+        stat = CSVFILE.stat()
+        if _CACHE["mtime"] == stat.st_mtime:
+            return _CACHE["df"]
+        with open(CSVFILE, mode="rb") as csvfile:
+            if _CACHE["df"] is None:
+                # pyarrow parses the ISO-8601 timestamps in native code
+                # and hands back a tz-aware column directly; index_col is
+                # set afterwards because combining it with the pyarrow
+                # engine crashes on pandas >= 2.1
+                new = pd.read_csv(
+                    csvfile,
+                    parse_dates=["timestamp"],
+                    dtype={"weight": "float32"},
+                    engine="pyarrow",
+                ).set_index("timestamp")
+            else:
+                csvfile.seek(_CACHE["offset"])
+                tail = csvfile.read()
+                if tail:
+                    new = pd.read_csv(
+                        io.BytesIO(tail),
+                        header=None,
+                        names=["timestamp", "weight"],
+                        index_col="timestamp",
+                        dtype={"weight": "float32"},
+                        engine="c",
+                    )
+                    # explicit format: no per-row inference, no dateutil
+                    new.index = pd.to_datetime(
+                        new.index, format="ISO8601", utc=True
+                    )
+                else:
+                    new = None
+            offset = csvfile.tell()
+        if new is not None and not new.empty:
+            if getattr(new.index, "tz", None) is None:
+                new.index = pd.to_datetime(new.index, utc=True)
+            # force nanosecond resolution: pyarrow hands back a
+            # datetime64[s] index, and all the int64 timestamp math
+            # (_period_ns, the kernel cutoff) assumes nanoseconds
+            new.index = new.index.tz_convert("Europe/Brussels").as_unit(
+                "ns"
+            )
+            if _CACHE["df"] is None:
+                _CACHE["df"] = new
+            else:
+                _CACHE["df"] = pd.concat([_CACHE["df"], new], copy=False)
+        _CACHE["offset"] = offset
+        _CACHE["mtime"] = stat.st_mtime
+        return _CACHE["df"]
+
+
+_NUM_RE = re.compile(r"\s*(\d{2,3}(?:[.,]\d+)?)\s*")
+
 
 class WeightFilter(MessageFilter):
     """Check if the given weight is acceptable or not."""
@@ -57,11 +274,11 @@ class WeightFilter(MessageFilter):
     @staticmethod
     def filter(message):
         """Check if the given weight is acceptable or not."""
-        try:
-            weight = float(message.text)
-            return 50 < weight < 150
-        except ValueError:
+        match = _NUM_RE.fullmatch(message.text or "")
+        if not match:
             return False
+        weight = float(match.group(1).replace(",", "."))
+        return 50 < weight < 150
 
 
 # pylint: disable=unused-argument
@@ -89,7 +306,14 @@ async def bot_weight(update: telegram.Update, context: CallbackContext):
     weight = update.message.text
     store_weight(weight)
     await update.message.reply_text(f"{weight}kg successfully stored!")
-    await bot_stats(update, context, last="100d", resample="10d", goal=False)
+    # render the stats off the critical reply path; the confirmation
+    # above must not wait for the plot. The application tracks the task
+    # and routes exceptions through the registered error handlers,
+    # unlike a bare asyncio.create_task.
+    context.application.create_task(
+        bot_stats(update, context, last="100d", resample="10d", goal=False),
+        update=update,
+    )
 
 
 # pylint: disable=too-many-locals
@@ -107,45 +331,62 @@ async def bot_stats(
         action=telegram.constants.ChatAction.TYPING,
     )
 
-    data = pd.read_csv(
-        CONFIG["csvfile"], parse_dates=["timestamp"], index_col="timestamp"
-    )
-    data.index = pd.to_datetime(data.index, utc=True).tz_convert(
-        "Europe/Brussels"
-    )
-
-    weekweight_mean_weight = data.last("7d").weight.mean()
+    data = _load_data()
 
+    ts_i8 = data.index.asi8
     if last:
-        data = data.last(last)
-
-    weight_min_weight = data.loc[data.weight.idxmin()].weight
-    weight_min_timestamp = pendulum.instance(
-        data.weight.idxmin()
-    ).diff_for_humans()
-
-    weight_max_weight = data.loc[data.weight.idxmax()].weight
-    weight_max_timestamp = pendulum.instance(
-        data.weight.idxmax()
-    ).diff_for_humans()
-
-    means = data.resample(resample, kind="period").mean()
-    weight_orig = means.weight[0]
-    weight_now = means.weight[-1]
+        # trailing-window slice by binary search on the sorted int64
+        # index, instead of DataFrame.last's offset arithmetic
+        start = int(np.searchsorted(ts_i8, ts_i8[-1] - _period_ns(last)))
+        data = data.iloc[start:]
+        ts_i8 = ts_i8[start:]
+    weights = data.weight.to_numpy(copy=False)
+    cutoff = ts_i8[-1] - 7 * 86_400 * 1_000_000_000
+    (
+        weekweight_mean_weight,
+        imin,
+        imax,
+        bucket_starts,
+        bucket_means,
+    ) = _stats_kernel(ts_i8, weights, cutoff, _period_ns(resample))
+
+    weight_min_weight = weights[imin]
+    weight_min_timestamp = _humans(data.index[imin])
+
+    weight_max_weight = weights[imax]
+    weight_max_timestamp = _humans(data.index[imax])
+
+    means = pd.Series(
+        bucket_means,
+        index=pd.to_datetime(bucket_starts, utc=True).tz_convert(
+            data.index.tz
+        ),
+        name="weight",
+    )
+    weight_orig = means.iloc[0]
+    weight_now = means.iloc[-1]
     weight_loss = weight_orig - weight_now
     weight_loss_period = (
         data.index.max() - data.index.min()
     ) / np.timedelta64(1, "D")
-    weight_goal = weight_orig + (
-        12 * float(CONFIG["goal"]) / 365 * weight_loss_period
+    weight_goal = weight_orig + GOAL_SLOPE * weight_loss_period
+
+    # convert the timestamps to matplotlib date floats once, instead of
+    # having the registered converter do it point by point
+    xnum = mdates.date2num(data.index.to_pydatetime())
+    means_xnum = mdates.date2num(means.index.to_pydatetime())
+
+    fig, axes = _make_axes(last, resample, goal)
+    axes.cla()
+    axes.plot(xnum, weights, "k.")
+    axes.plot(
+        means_xnum,
+        means.to_numpy(),
+        "g" if weight_now <= weight_goal else "r",
     )
-
-    fig, axes = plt.subplots()
-    axes.plot(data, "k.")
-    means.plot.line(ax=axes, style="g" if weight_now <= weight_goal else "r")
     if goal:
         axes.plot(
-            [means.index[0].start_time, means.index[-1].start_time],
+            [means_xnum[0], means_xnum[-1]],
             [weight_orig, weight_goal],
             "--",
             color="orange",
@@ -154,59 +395,93 @@ async def bot_stats(
             [min(weight_goal, weight_min_weight) - 1, weight_max_weight + 1]
         )
     axes.yaxis.set_ticks_position("both")
-    axes.get_legend().remove()
     axes.tick_params(labeltop=False, labelright=True)
-    plt.xlabel("")
-    plt.ylabel("kg")
+    axes.xaxis_date()
+    axes.xaxis.set_major_formatter(
+        mdates.ConciseDateFormatter(mdates.AutoDateLocator())
+    )
+    axes.set_xlabel("")
+    axes.set_ylabel("kg")
     fig.autofmt_xdate()
 
+    # render before the first await: the shared axes must not be touched
+    # by a concurrently running handler while this plot is in flight
+    # tight_layout + print_png skips the savefig dispatch layer and the
+    # double draw that bbox_inches="tight" performs
+    fig.tight_layout()
+    figbuf = io.BytesIO()
+    fig.canvas.print_png(figbuf)
+    figbuf.seek(0)
+
     await update.message.reply_text(
-        f"Your weight mean the past week is {weekweight_mean_weight:.1f}kg. "
+        f"Your weight mean the past week is "
+        f"{weekweight_mean_weight:.1f}kg. "
         f"The minimum over the shown period was {weight_min_weight:.1f}kg "
-        f"({weight_min_timestamp}) and maximum was {weight_max_weight:.1f}kg "
-        f"({weight_max_timestamp})."
+        f"({weight_min_timestamp}) and maximum was "
+        f"{weight_max_weight:.1f}kg ({weight_max_timestamp})."
     )
     await context.bot.send_chat_action(
         chat_id=update.message.chat_id,
         action=telegram.constants.ChatAction.TYPING,
     )
-
-    with tempfile.NamedTemporaryFile(suffix=".png") as figfile:
-        fig.savefig(figfile.name, bbox_inches="tight")
-        await update.message.reply_photo(figfile)
+    await update.message.reply_photo(figbuf)
     gainedlost = "lost" if weight_loss >= 0 else "gained"
     await update.message.reply_text(
         f"You have {gainedlost} {abs(weight_loss):.1f}kg "
         f"in {weight_loss_period:.0f} days"
     )
-    plt.close(fig)
 
 
 def store_weight(weight):
-    """Write the given weight to the CSV file with the current timestamp."""
-    with open(
-        CONFIG["csvfile"], mode="a", newline="", encoding="utf-8"
-    ) as csvfile:
-        weightwriter = csv.writer(csvfile)
-        weightwriter.writerow([pendulum.now(), weight])
+    """Record the given weight with the current timestamp.
+
+    The CSV row is buffered and flushed in batches; the cached DataFrame
+    is updated immediately so /stats always sees the new measurement.
+    """
+    weight = float(weight.strip().replace(",", "."))
+    now = pendulum.now(_TZ)
+    flush_now = False
+    with _CACHE_LOCK:
+        _PENDING.append(f"{now.isoformat()},{weight:.2f}\n")
+        if _CACHE["df"] is not None:
+            # concat a one-row frame: .loc with a pendulum label would
+            # degrade the DatetimeIndex to a plain object Index, and
+            # np.float32 keeps the column from upcasting to float64
+            row = pd.DataFrame(
+                {"weight": np.float32(weight)},
+                index=pd.DatetimeIndex(
+                    [pd.Timestamp(now).tz_convert(_CACHE["df"].index.tz)],
+                    name="timestamp",
+                ),
+            )
+            _CACHE["df"] = pd.concat([_CACHE["df"], row], copy=False)
+        else:
+            # nothing cached to piggyback on, so the row must hit the file
+            # before the next cold load
+            flush_now = True
+    if flush_now:
+        _flush_pending()
 
 
 def main():
     """Run bot."""
-    csvfile_path = Path(CONFIG["csvfile"])
-    if not csvfile_path.is_file() or csvfile_path.stat().st_size == 0:
-        with csvfile_path.open(
-            mode="w", newline="", encoding="utf-8"
-        ) as csvfile:
-            weightwriter = csv.writer(csvfile)
-            weightwriter.writerow(["timestamp", "weight"])
-
-    application = Application.builder().token(CONFIG["token"]).build()
+    if not CSVFILE.is_file() or CSVFILE.stat().st_size == 0:
+        with CSVFILE.open(mode="w", encoding="utf-8") as csvfile:
+            csvfile.write("timestamp,weight\n")
+
+    application = (
+        Application.builder()
+        .token(CONFIG["token"])
+        .post_init(_start_flush_task)
+        .post_shutdown(_stop_flush_task)
+        .build()
+    )
     application.add_handler(CommandHandler("start", bot_start))
     application.add_handler(CommandHandler("stats", bot_stats))
     application.add_handler(MessageHandler(WeightFilter(), bot_weight))
     application.add_error_handler(bot_error)
 
+    atexit.register(_flush_pending)
     application.run_polling()
 
 